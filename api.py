@@ -1,12 +1,38 @@
 from flask import Flask, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 from flasgger import Swagger
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
+import hashlib
 import logging
-import aiohttp
+import os
+import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date
+
+# jsonify çıktısını stdlib json yerine orjson (C) ile kodlayan sağlayıcı;
+# orjson'un bilmediği tipler Flask'ın varsayılan dönüştürücüsüne bırakılır
+class OrjsonProvider(DefaultJSONProvider):
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.option)
+        return self._app.response_class(body, mimetype=self.mimetype)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 swagger = Swagger(app)
 
 # Loglama ayarları
@@ -15,58 +41,308 @@ logger = logging.getLogger(__name__)
 
 # Cache için önbellek süresi (saniye cinsinden, örneğin 1 saat = 3600 saniye)
 CACHE_TIMEOUT = 3600
-cache = {}
+# Cache'te tutulacak en fazla kayıt sayısı; aşılınca en az kullanılan silinir
+CACHE_MAX_ENTRIES = 512
+# Cache'teki verilerin kodlanmış JSON boyutu üst sınırı (bayt)
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+cache = OrderedDict()
+cache_bytes = 0  # Kayıt eklenip silindikçe güncellenir, yeniden hesaplanmaz
+cache_lock = threading.Lock()
+
+# Upstream isteği için zaman aşımı (saniye)
+REQUEST_TIMEOUT = 30
+
+# Sık istenen tarih aralıkları, süreleri dolmadan arka planda yenilenir
+HOT_KEYS_MAX = 16  # Takip edilen en fazla tarih aralığı (en son istenenler)
+CACHE_REFRESH_CONCURRENCY = 4  # Bir turda upstream'e aynı anda en fazla istek
+CACHE_REFRESH_CHECK_INTERVAL = 15  # Yenilenmesi gereken kayıtların kontrol aralığı (saniye)
+# Kayıt, yaşı CACHE_TIMEOUT - CACHE_REFRESH_MARGIN'i geçince yenilenir. Pay, bir
+# kontrol aralığı ile tüm isteklerin zaman aşımına uğradığı en uzun turu kapsar.
+CACHE_REFRESH_MARGIN = CACHE_REFRESH_CHECK_INTERVAL + REQUEST_TIMEOUT * -(-HOT_KEYS_MAX // CACHE_REFRESH_CONCURRENCY)
+hot_keys = OrderedDict()
+hot_keys_lock = threading.Lock()
+cache_refresher = None
+cache_refresher_lock = threading.Lock()
+
+# Uygulama ömrü boyunca paylaşılan HTTP oturumu (keep-alive ve bağlantı havuzu).
+# Accept-Encoding urllib3'e bırakılır: "br" yalnızca brotli kuruluysa gönderilir.
+http = requests.Session()
+http.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
+# Upstream 304 döndüğünde get_border_data'nın veri yerine döndürdüğü işaret
+NOT_MODIFIED = object()
+
+# Sayfadaki ilk tablonun satırlarını hücre metinleri listesi olarak döner;
+# tablo yoksa None döner. Satırlar tek geçişte oluşturulur ve boş satırlar
+# (örn. yalnızca <th> içeren başlık) aynı döngüde atlanır. Kapı filtresi
+# burada uygulanmaz: cache filtrelenmemiş veriyi tutar.
+def parse_border_table(content):
+    table = LexborHTMLParser(content).css_first("table")
+    if table is None:
+        return None
+    data = []
+    # Tekrarlanan hücre metinleri (ülke, yoğunluk durumu vb.) tek bir str
+    # nesnesini paylaşır; sys.intern yerine yanıta özel sözlük kullanılır
+    cells = {}
+    for row in table.css("tr"):
+        # Satır başına CSS sorgusu yerine doğrudan alt düğümler gezilir
+        data_row = [cells.setdefault(text, text)
+                    for text in (col.text().strip() for col in row.iter() if col.tag == "td")]
+        if data_row:
+            data.append(data_row)
+    return data
+
+# Sayfanın ilk baytlarındaki <meta charset=...> / content="...; charset=..." bildirimi
+META_CHARSET_PATTERN = re.compile(rb"""<meta[^>]+charset=["']?([A-Za-z0-9_.:-]+)""", re.IGNORECASE)
+
+# Yanıt gövdesini parser'a verilecek biçimde döner. lexbor byte'ları her zaman
+# UTF-8 okur (meta charset'e bakmaz); bu yüzden ham byte'lar yalnızca karakter
+# seti UTF-8 ya da bilinmiyorsa doğrudan verilir, aksi halde önce çözülür.
+# Karakter seti önce Content-Type başlığından, yoksa meta etiketinden alınır.
+def response_markup(response):
+    content = response.content
+    if "charset=" in response.headers.get("Content-Type", "").lower():
+        charset = response.encoding
+    else:
+        match = META_CHARSET_PATTERN.search(content, 0, 2048)
+        charset = match.group(1).decode("ascii") if match else None
+    if charset is None or charset.lower().replace("_", "-") in ("utf-8", "utf8"):
+        return content
+    try:
+        return content.decode(charset, errors="replace")
+    except LookupError:
+        return content
 
 # Siteden verileri çekme fonksiyonu
-async def get_border_data(start_date, end_date):
+# etag/last_modified verilirse koşullu istek yapılır; sayfa değişmediyse
+# veri olarak NOT_MODIFIED döner ve HTML indirilip parse edilmez.
+def get_border_data(start_date, end_date, etag=None, last_modified=None):
     url = f"https://www.und.org.tr/sinir-kapilari-yogunluk-durumu?START_DATE={start_date}&END_DATE={end_date}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status != 200:
-                logger.error(f"Web sitesine erişilemedi, HTTP Durum Kodu: {response.status}")
-                return None, f"Web sitesine erişilemedi, HTTP Durum Kodu: {response.status}"
-            content = await response.text()
-    
-    soup = BeautifulSoup(content, "html.parser")
-    
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        response = http.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        logger.error(f"Web sitesine erişilemedi: {e}")
+        return None, f"Web sitesine erişilemedi: {e}", (None, None)
+    if response.status_code == 304:
+        return NOT_MODIFIED, None, (etag, last_modified)
+    if response.status_code != 200:
+        logger.error(f"Web sitesine erişilemedi, HTTP Durum Kodu: {response.status_code}")
+        return None, f"Web sitesine erişilemedi, HTTP Durum Kodu: {response.status_code}", (None, None)
+    validators = (response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    logger.debug(f"Upstream Content-Encoding: {response.headers.get('Content-Encoding')}")
+
     # Verileri parse etme
-    data = []
-    table = soup.find("table")
-    if table:
-        rows = table.find_all("tr")
-        for row in rows:
-            columns = row.find_all("td")
-            data_row = [col.text.strip() for col in columns]
-            if data_row:
-                data.append(data_row)
-    else:
-        return None, "Veriler alınamadı, sayfada tablo bulunamadı."
+    data = parse_border_table(response_markup(response))
+    if data is None:
+        return None, "Veriler alınamadı, sayfada tablo bulunamadı.", (None, None)
     
-    return data, None
+    return data, None, validators
+
+# Aynı tarih aralığı için süren yenilemeler (tek uçuş / single-flight)
+inflight = {}
+inflight_lock = threading.Lock()
+
+# Aynı anahtar için eşzamanlı çağrılar tek bir func çağrısını paylaşır;
+# ilk gelen çalıştırır, diğerleri onun sonucunu bekler.
+def run_once(key, func, *args):
+    with inflight_lock:
+        future = inflight.get(key)
+        leader = future is None
+        if leader:
+            future = inflight[key] = Future()
+
+    if not leader:
+        return future.result()
+
+    try:
+        result = func(*args)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with inflight_lock:
+            del inflight[key]
+
+# Tanınan tarih biçimleri: YYYY-MM-DD ve DD-MM-YYYY
+ISO_DATE_PATTERN = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+DMY_DATE_PATTERN = re.compile(r"[0-9]{2}-[0-9]{2}-[0-9]{4}")
+
+# Tarihi tek seferde ayrıştırır (strptime'dan hızlı); tanınmazsa None döner.
+# Tarihler upstream'e olduğu gibi iletilir; bu yalnızca aralık kontrolü içindir.
+def parse_date(value):
+    try:
+        if ISO_DATE_PATTERN.fullmatch(value):
+            return date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+        if DMY_DATE_PATTERN.fullmatch(value):
+            return date(int(value[6:10]), int(value[3:5]), int(value[0:2]))
+    except ValueError:
+        pass
+    return None
 
 # Verileri filtreleme fonksiyonu (belirli kapıları filtreler)
 def filter_border_data(data, kapilar):
     if not kapilar:
         return data  # Kapı filtrelemesi yapılmadıysa, tüm verileri döner
-    return [row for row in data if row[0] in kapilar]
+    wanted = frozenset(kapilar)  # Satır başına O(1) üyelik kontrolü
+    return [row for row in data if row[0] in wanted]
+
+# Veriyi JSON'a kodlar ve yanıt ETag'i için gövdenin özetini çıkarır
+def encode_border_data(data):
+    data_json = orjson.dumps(data)
+    return data_json, hashlib.blake2b(data_json, digest_size=16).hexdigest()
 
-# Cache kontrol fonksiyonu
+# Cache kontrol fonksiyonu; veriyi, önceden kodlanmış halini ve yazılma
+# zamanını döner
 def get_cached_data(key):
-    if key in cache:
-        data, timestamp = cache[key]
-        if time.time() - timestamp < CACHE_TIMEOUT:  # Cache süresi kontrolü
-            return data
-        else:
-            del cache[key]  # Cache süresi dolduysa, silinir
-    return None
+    with cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            data, encoded, timestamp, _, _ = cache[key]
+            if time.time() - timestamp < CACHE_TIMEOUT:  # Cache süresi kontrolü
+                return data, encoded, timestamp
+            # Süresi dolan kayıt silinmez; upstream'e koşullu istek için saklanır
+    return None, None, None
+
+# Süresi dolmuş olsa da cache kaydının verisini ve doğrulayıcılarını döner
+def get_stale_cache_entry(key):
+    with cache_lock:
+        if key in cache:
+            data, encoded, _, etag, last_modified = cache[key]
+            return data, encoded, etag, last_modified
+    return None, None, None, None
+
+# Kaydın yazılma zamanını döner (LRU sırasını değiştirmez); kayıt yoksa None
+def get_cache_timestamp(key):
+    with cache_lock:
+        entry = cache.get(key)
+    return entry[2] if entry is not None else None
+
+# Cache'e veri ekleme fonksiyonu; veri TTL başına bir kez kodlanır.
+# Kayıt sayısı veya toplam boyut sınırı aşılırsa en az kullanılanlar silinir.
+# Kodlanmış veriyi ve kaydın zamanını döner.
+def set_cache_data(key, data, etag=None, last_modified=None, encoded=None):
+    global cache_bytes
+    if encoded is None:
+        encoded = encode_border_data(data)
+    timestamp = time.time()
+    with cache_lock:
+        old = cache.pop(key, None)
+        if old is not None:
+            cache_bytes -= len(old[1][0])
+        cache[key] = (data, encoded, timestamp, etag, last_modified)
+        cache_bytes += len(encoded[0])
+        while len(cache) > 1 and (len(cache) > CACHE_MAX_ENTRIES or cache_bytes > CACHE_MAX_BYTES):
+            _, evicted = cache.popitem(last=False)
+            cache_bytes -= len(evicted[1][0])
+    return encoded, timestamp
+
+# Yanıtı oluşturur; filtre yoksa cache'teki hazır JSON gövdeye eklenir,
+# filtre varsa yalnızca filtrelenmiş satırlar kodlanır. İstemcinin
+# If-None-Match başlığı ETag ile eşleşirse gövdesiz 304 döner.
+def border_data_response(source, data, encoded, timestamp, kapilar):
+    if kapilar:
+        data_json, data_etag = encode_border_data(filter_border_data(data, kapilar))
+    else:
+        data_json, data_etag = encoded
+    body = b'{"source":"' + source.encode() + b'","data":' + data_json + b"}"
+    response = app.response_class(body, mimetype="application/json")
+    # ETag yalnızca veriyi kapsar; "source" değişebildiği için zayıf ETag
+    response.set_etag(data_etag, weak=True)
+    response.cache_control.public = True
+    # İstemciler/CDN'ler veriyi yalnızca cache kaydının kalan süresi kadar tutar
+    response.cache_control.max_age = max(0, int(CACHE_TIMEOUT - (time.time() - timestamp)))
+    return response.make_conditional(request)
+
+# Tarih aralığının verisini upstream'den (süresi dolmuş kayıt varsa koşullu
+# istekle) yeniler ve cache'e yazar; (data, encoded, timestamp, source, error) döner.
+# Eşzamanlı çağrılar tek bir yenilemeyi paylaşır: upstream'e bir kez gidilir,
+# veri bir kez kodlanır ve cache'e bir kez yazılır.
+def refresh_border_data(start_date, end_date):
+    cache_key = f"{start_date}_{end_date}"
+    return run_once(cache_key, fetch_and_cache_border_data, cache_key, start_date, end_date)
+
+def fetch_and_cache_border_data(cache_key, start_date, end_date):
+    stale_data, stale_encoded, etag, last_modified = get_stale_cache_entry(cache_key)
+    data, error, (etag, last_modified) = get_border_data(start_date, end_date, etag, last_modified)
+    if error:
+        return None, None, None, None, error
+
+    if data is NOT_MODIFIED:
+        # Upstream değişmedi; eski veri yeniden geçerli sayılır
+        _, timestamp = set_cache_data(cache_key, stale_data, etag, last_modified, stale_encoded)
+        logger.info("Cache upstream ile doğrulandı (304).")
+        return stale_data, stale_encoded, timestamp, "cache", None
 
-# Cache'e veri ekleme fonksiyonu
-def set_cache_data(key, data):
-    cache[key] = (data, time.time())
+    # Filtrelenmemiş veriyi cache'e ekleme
+    encoded, timestamp = set_cache_data(cache_key, data, etag, last_modified)
+    logger.info("Canlı veri kullanıldı.")
+    return data, encoded, timestamp, "live", None
+
+# İstenen tarih aralığını sık kullanılanlar listesine ekler
+def record_hot_key(start_date, end_date):
+    key = f"{start_date}_{end_date}"
+    with hot_keys_lock:
+        hot_keys[key] = (start_date, end_date, time.time())
+        hot_keys.move_to_end(key)
+        while len(hot_keys) > HOT_KEYS_MAX:
+            hot_keys.popitem(last=False)
+
+# Son CACHE_TIMEOUT içinde istenmiş aralıklardan cache kaydının süresi dolmak
+# üzere olanları yeniler; daha önce istenmiş aralıklar listeden çıkarılır.
+# Cache'te olmayan aralıklar ilk kullanıcı isteğinde çekilir. İstekler tek uçuş
+# kilidinden geçtiği için aynı anda gelen kullanıcı isteğiyle upstream'e iki
+# kez gidilmez.
+def refresh_hot_keys():
+    now = time.time()
+    with hot_keys_lock:
+        for key, (_, _, requested_at) in list(hot_keys.items()):
+            if now - requested_at > CACHE_TIMEOUT:
+                del hot_keys[key]
+        candidates = list(hot_keys.items())
+
+    ranges = []
+    for key, (start_date, end_date, _) in candidates:
+        timestamp = get_cache_timestamp(key)
+        if timestamp is not None and now - timestamp > CACHE_TIMEOUT - CACHE_REFRESH_MARGIN:
+            ranges.append((start_date, end_date))
+    if not ranges:
+        return
+
+    with ThreadPoolExecutor(max_workers=CACHE_REFRESH_CONCURRENCY) as pool:
+        results = pool.map(lambda r: refresh_border_data(*r), ranges)
+        for (start_date, end_date), (_, _, _, _, error) in zip(ranges, results):
+            if error:
+                logger.warning(f"Cache yenilenemedi ({start_date} - {end_date}): {error}")
+
+def cache_refresh_loop():
+    while True:
+        time.sleep(CACHE_REFRESH_CHECK_INTERVAL)
+        try:
+            refresh_hot_keys()
+        except Exception:
+            logger.exception("Cache yenileme turu başarısız oldu.")
+
+# Yenileme iş parçacığını süreç başına bir kez başlatır. İlk istekte çağrılır,
+# böylece gunicorn gibi fork eden sunucularda isteği karşılayan süreçte çalışır.
+def start_cache_refresher():
+    global cache_refresher
+    if cache_refresher is not None:  # Başlatıldıktan sonra kilit alınmaz
+        return
+    with cache_refresher_lock:
+        if cache_refresher is None:
+            cache_refresher = threading.Thread(target=cache_refresh_loop, name="cache-refresher", daemon=True)
+            cache_refresher.start()
 
 # API endpoint
 @app.route('/border-data', methods=['GET'])
-async def border_data():
+def border_data():
     """
     Get border data based on the provided start and end dates.
     ---
@@ -103,6 +379,8 @@ async def border_data():
                 type: array
                 items:
                   type: string
+      304:
+        description: Data unchanged since the ETag sent in If-None-Match
       400:
         description: Bad request due to missing parameters
       500:
@@ -117,29 +395,42 @@ async def border_data():
         logger.warning("Gerekli parametreler eksik: start_date ve end_date.")
         return jsonify({"error": "Lütfen start_date ve end_date parametrelerini sağlayın."}), 400
 
-    # Cache anahtarı (aynı tarih ve kapı kombinasyonu için aynı anahtar)
-    cache_key = f"{start_date}_{end_date}_{'_'.join(kapilar)}"
+    # Tarih aralığı kontrolü (yalnızca iki tarih de ayrıştırılabildiğinde)
+    start = parse_date(start_date)
+    end = parse_date(end_date)
+    if start is not None and end is not None and start > end:
+        logger.warning(f"Tarih aralığı hatalı: {start_date} > {end_date}")
+        return jsonify({"error": "start_date, end_date'ten sonra olamaz."}), 400
+
+    # Sık istenen aralıklar arka planda süresi dolmadan yenilenir
+    start_cache_refresher()
+    record_hot_key(start_date, end_date)
+
+    # Cache anahtarı (aynı tarih aralığı için aynı anahtar; kapı filtresi
+    # cache'ten sonra uygulanır, böylece farklı kapı seçimleri aynı kaydı paylaşır)
+    cache_key = f"{start_date}_{end_date}"
     
     # Cache kontrolü
-    cached_data = get_cached_data(cache_key)
-    if cached_data:
+    cached_data, cached_encoded, cached_at = get_cached_data(cache_key)
+    if cached_data is not None:
         logger.info("Cache kullanıldı.")
-        return jsonify({"source": "cache", "data": cached_data})
+        return border_data_response("cache", cached_data, cached_encoded, cached_at, kapilar)
 
     # Veriyi siteden çekme
-    data, error = await get_border_data(start_date, end_date)
+    data, encoded, timestamp, source, error = refresh_border_data(start_date, end_date)
     if error:
         logger.error(f"Veri çekme hatası: {error}")
         return jsonify({"error": error}), 500
 
-    # Veri filtreleme
-    filtered_data = filter_border_data(data, kapilar)
-    
-    # Veriyi cache'e ekleme
-    set_cache_data(cache_key, filtered_data)
-
-    logger.info("Canlı veri kullanıldı.")
-    return jsonify({"source": "live", "data": filtered_data})
+    return border_data_response(source, data, encoded, timestamp, kapilar)
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    # Geliştirme sunucusu; hata ayıklayıcı ve yeniden yükleyici yalnızca
+    # FLASK_DEBUG=1 ile açılır. Üretimde cache ve tek uçuş kilitleri süreç içi
+    # olduğundan tek süreç, çok iş parçacığı tercih edilmelidir, örn:
+    #   gunicorn --workers 1 --threads 8 api:app
+    app.run(
+        port=int(os.environ.get("PORT", 5000)),
+        debug=os.environ.get("FLASK_DEBUG") == "1",
+        threaded=True,
+    )